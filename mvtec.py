@@ -55,6 +55,7 @@ class MVTecDataset(torch.utils.data.Dataset):
         h_flip_p=0,
         v_flip_p=0,
         scale=0,
+        gpu_transforms=False,
         **kwargs,
     ):
         """
@@ -71,6 +72,10 @@ class MVTecDataset(torch.utils.data.Dataset):
                    data should be used. Has to be an option taken from
                    DatasetSplit, e.g. mvtec.DatasetSplit.TRAIN. Note that
                    mvtec.DatasetSplit.TEST will also load mask data.
+            gpu_transforms: [bool]. If true, images are only decoded to
+                            uint8 tensors here; resize/crop/normalize are
+                            expected to run on the GPU batch (see
+                            utils.gpu_transform).
         """
         super().__init__()
         self.source = source
@@ -80,6 +85,21 @@ class MVTecDataset(torch.utils.data.Dataset):
         self.transform_std = IMAGENET_STD
         self.transform_mean = IMAGENET_MEAN
         self.imgpaths_per_class, self.data_to_iterate = self.get_image_data()
+        # Column (SoA) views of data_to_iterate so consumers can grab a
+        # whole column without re-walking the tuple list.
+        if self.data_to_iterate:
+            columns = [list(col) for col in zip(*self.data_to_iterate)]
+        else:
+            columns = [[], [], [], []]
+        self.classnames, self.anomalies, self.image_paths, self.mask_paths = columns
+        self.gpu_transforms = gpu_transforms
+
+        if gpu_transforms:
+            # Decode only; the heavy per-image work happens on the GPU batch.
+            self.transform_img = transforms.PILToTensor()
+            self.transform_mask = transforms.PILToTensor()
+            self.imagesize = (3, imagesize, imagesize)
+            return
 
         self.transform_img = [
             transforms.Resize(resize),
@@ -116,7 +136,10 @@ class MVTecDataset(torch.utils.data.Dataset):
             mask = PIL.Image.open(mask_path)
             mask = self.transform_mask(mask)
         else:
-            mask = torch.zeros([1, *image.size()[1:]])
+            # Match the real masks' dtype so default collate can stack
+            # batches that mix good and defect samples.
+            mask_dtype = torch.uint8 if self.gpu_transforms else torch.float32
+            mask = torch.zeros([1, *image.size()[1:]], dtype=mask_dtype)
 
         return {
             "image": image,
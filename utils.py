@@ -1,29 +1,174 @@
-import csv
+import concurrent.futures
+import io
 import logging
 import os
 import random
+import shutil
+import subprocess
+import tarfile
+import threading
 
-import matplotlib.pyplot as plt
+import matplotlib.cm
 import numpy as np
 import PIL
 import torch
 import tqdm
 import requests
+from torchvision import transforms
+from torchvision.io import ImageReadMode, read_image
 
 from mvtec import *
 
+try:
+    import numba
+except ImportError:  # optional; the NumPy denormalize path is used instead
+    numba = None
+
 LOGGER = logging.getLogger(__name__)
 
-def get_data(url = 'https://www.mydrive.ch/shares/38536/3830184030e49fe74747669442f0f282/download/420938113-1629952094/mvtec_anomaly_detection.tar.xz'):
+
+if numba is not None:
+    # No parallel=True: the kernel is entered concurrently from the
+    # plot_segmentation_images thread pool, which numba's default
+    # threading layer does not support (and the pool already uses all
+    # cores).
+    @numba.njit(fastmath=True, cache=True)
+    def _denorm_u8(img, std, mean, out):
+        """Fused (img*std+mean)->clip->uint8 in one pass over memory."""
+        channels, height, width = img.shape
+        for c in range(channels):
+            s = std[c]
+            m = mean[c]
+            for y in range(height):
+                for x in range(width):
+                    v = img[c, y, x] * s + m
+                    if v < 0:
+                        v = 0
+                    elif v > 255:
+                        v = 255
+                    out[c, y, x] = np.uint8(v)
+
+# 256-entry uint8 RGB lookup table so colormapping a segmentation is a
+# single gather instead of matplotlib's Normalize+Colormap pipeline.
+_VIRIDIS_LUT = (
+    matplotlib.cm.viridis(np.linspace(0, 1, 256))[:, :3] * 255
+).astype(np.uint8)
+
+def _download_range(url, fd, start, end, pbar):
+    """Download bytes [start, end] of url and pwrite them at their offset."""
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    with requests.get(url, stream=True, headers=headers) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            # Server ignored the Range header; writing its full body at
+            # this offset would corrupt the file.
+            raise requests.HTTPError(
+                'expected 206 Partial Content, got {}'.format(
+                    response.status_code
+                ),
+                response=response,
+            )
+        # Keep the raw encoded stream: range offsets are in encoded bytes,
+        # so decoding here would desync lengths from the requested range.
+        offset = start
+        while True:
+            chunk = response.raw.read(1024 * 1024)
+            if not chunk:
+                break
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            pbar.update(len(chunk))
+
+
+def _feed_pipe(src, dst):
+    """Pump src into dst in 1 MiB chunks, closing dst when src is drained."""
+    try:
+        shutil.copyfileobj(src, dst, length=1024 * 1024)
+    finally:
+        dst.close()
+
+
+def get_data(url = 'https://www.mydrive.ch/shares/38536/3830184030e49fe74747669442f0f282/download/420938113-1629952094/mvtec_anomaly_detection.tar.xz', num_connections = 16, extract_to = None):
     save_path = "mvtec_anomaly_detection.tar.xz"
 
+    if extract_to is not None:
+        # Giải nén trực tiếp từ stream, không ghi file .tar.xz ra đĩa
+        print("Downloading and extracting...")
+        with requests.get(url, stream=True) as response:
+            response.raw.decode_content = True
+            if shutil.which('xz'):
+                # xz -T0 decompresses on all cores; tarfile's lzma path
+                # is single-threaded.
+                proc = subprocess.Popen(
+                    ['xz', '-dc', '-T0'],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+                feeder = threading.Thread(
+                    target=_feed_pipe, args=(response.raw, proc.stdin)
+                )
+                feeder.start()
+                with tarfile.open(fileobj=proc.stdout, mode='r|') as tf:
+                    tf.extractall(path=extract_to)
+                feeder.join()
+                proc.stdout.close()
+                proc.wait()
+            else:
+                with tarfile.open(fileobj=response.raw, mode='r|xz') as tf:
+                    tf.extractall(path=extract_to)
+        print("Download thành công!")
+        return
+
     # Tải file từ URL
     print("Downloading file...")
-    response = requests.get(url, stream=True)
-    with open(save_path, 'wb') as f:
-        # Ghi dữ liệu từ response vào file
-        for chunk in response.iter_content(chunk_size=1024):
-            f.write(chunk)
+    head = requests.head(url, allow_redirects=True)
+    total = int(head.headers.get('Content-Length', 0))
+    accepts_ranges = head.headers.get('Accept-Ranges', 'none').lower() == 'bytes'
+
+    downloaded = False
+    if total and accepts_ranges and num_connections > 1:
+        # Tải song song bằng các Range request, mỗi phần ghi vào offset riêng
+        try:
+            with open(save_path, 'wb') as f:
+                fd = f.fileno()
+                os.posix_fallocate(fd, 0, total)
+                part = -(-total // num_connections)
+                ranges = [
+                    (start, min(start + part, total) - 1)
+                    for start in range(0, total, part)
+                ]
+                with tqdm.tqdm(
+                    total=total, unit='B', unit_scale=True,
+                    desc=save_path, leave=False,
+                ) as pbar:
+                    with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=len(ranges)
+                    ) as executor:
+                        futures = [
+                            executor.submit(
+                                _download_range, url, fd, start, end, pbar
+                            )
+                            for start, end in ranges
+                        ]
+                        for future in futures:
+                            future.result()
+            downloaded = True
+        except requests.RequestException as exc:
+            LOGGER.warning(
+                "Range download failed (%s), falling back to single stream.",
+                exc,
+            )
+    if not downloaded:
+        with requests.get(url, stream=True) as response:
+            response.raw.decode_content = True
+            total = int(response.headers.get('Content-Length', 0))
+            with open(save_path, 'wb') as f:
+                # Ghi dữ liệu từ response vào file theo khối 1 MiB
+                with tqdm.tqdm.wrapattr(
+                    f, 'write', total=total, unit='B', unit_scale=True,
+                    desc=save_path, leave=False,
+                ) as out:
+                    shutil.copyfileobj(response.raw, out, length=1024 * 1024)
     print("Download thành công!")
 
 
@@ -55,52 +200,83 @@ def plot_segmentation_images(
         anomaly_scores = ["-1" for _ in range(len(image_paths))]
 
     os.makedirs(savefolder, exist_ok=True)
+    savenames = [
+        os.path.join(
+            savefolder,
+            "_".join(p.replace("\\", "/").split("/")[-save_depth:]),
+        )
+        for p in image_paths
+    ]
 
-    for image_path, mask_path, anomaly_score, segmentation in tqdm.tqdm(
-        zip(image_paths, mask_paths, anomaly_scores, segmentations),
-        total=len(image_paths),
-        desc="Generating Segmentation Images...",
-        leave=False,
-    ):
-        image = PIL.Image.open(image_path).convert("RGB")
+    def _render_one(item):
+        image_path, mask_path, anomaly_score, segmentation, savename = item
+        image = read_image(image_path, mode=ImageReadMode.RGB)
         image = image_transform(image)
         if not isinstance(image, np.ndarray):
             image = image.numpy()
+        # Materialize the HWC layout once so the concatenate+encode path
+        # below reads contiguous memory instead of strided CHW views.
+        panels = [np.ascontiguousarray(image.transpose(1, 2, 0))]
 
         if masks_provided:
             if mask_path is not None:
-                mask = PIL.Image.open(mask_path).convert("RGB")
+                mask = read_image(mask_path, mode=ImageReadMode.RGB)
                 mask = mask_transform(mask)
                 if not isinstance(mask, np.ndarray):
                     mask = mask.numpy()
             else:
                 mask = np.zeros_like(image)
-
-        savename = image_path.split("/")
-        savename = "_".join(savename[-save_depth:])
-        savename = os.path.join(savefolder, savename)
-        f, axes = plt.subplots(1, 2 + int(masks_provided))
-        axes[0].imshow(image.transpose(1, 2, 0))
-        axes[1].imshow(mask.transpose(1, 2, 0))
-        axes[2].imshow(segmentation)
-        f.set_size_inches(3 * (2 + int(masks_provided)), 3)
-        f.tight_layout()
-        f.savefig(savename)
-        plt.close()
+            panels.append(np.ascontiguousarray(mask.transpose(1, 2, 0)))
+
+        seg8 = np.clip(
+            segmentation * (255.0 / max(float(segmentation.max()), 1e-6)),
+            0, 255,
+        ).astype(np.uint8)
+        panels.append(_VIRIDIS_LUT[seg8])
+
+        panels = [
+            p if p.dtype == np.uint8
+            else np.clip(p * 255, 0, 255).astype(np.uint8)
+            for p in panels
+        ]
+        row = np.concatenate(panels, axis=1)
+        # Encode in memory so each file is one open/write/close instead of
+        # many small writes from the PNG encoder.
+        encoded = io.BytesIO()
+        PIL.Image.fromarray(row).save(encoded, format="PNG", optimize=False)
+        with open(savename + ".png", "wb") as f:
+            f.write(encoded.getbuffer())
+
+    # PNG encode and file writes release the GIL, so threads scale here.
+    max_workers = min(32, (os.cpu_count() or 1) * 2)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(tqdm.tqdm(
+            executor.map(
+                _render_one,
+                zip(image_paths, mask_paths, anomaly_scores, segmentations, savenames),
+            ),
+            total=len(image_paths),
+            desc="Generating Segmentation Images...",
+            leave=False,
+        ))
 
 
 def create_storage_folder(
     main_folder_path, project_folder, group_folder, run_name, mode="iterate"
 ):
-    os.makedirs(main_folder_path, exist_ok=True)
     project_path = os.path.join(main_folder_path, project_folder)
-    os.makedirs(project_path, exist_ok=True)
     save_path = os.path.join(project_path, group_folder, run_name)
     if mode == "iterate":
-        counter = 0
-        while os.path.exists(save_path):
-            save_path = os.path.join(project_path, group_folder + "_" + str(counter))
-            counter += 1
+        if os.path.exists(save_path):
+            # One directory scan instead of a stat per candidate suffix.
+            prefix = group_folder + "_"
+            counters = [
+                int(entry[len(prefix):])
+                for entry in os.listdir(project_path)
+                if entry.startswith(prefix) and entry[len(prefix):].isdigit()
+            ]
+            counter = max(counters) + 1 if counters else 0
+            save_path = os.path.join(project_path, prefix + str(counter))
         os.makedirs(save_path)
     elif mode == "overwrite":
         os.makedirs(save_path, exist_ok=True)
@@ -128,15 +304,24 @@ def fix_seeds(seed, with_torch=True, with_cuda=True):
         seed: [int] Seed value.
         with_torch: Flag. If true, torch-related seeds are fixed.
         with_cuda: Flag. If true, torch+cuda-related seeds are fixed
+
+    Returns:
+        A torch.Generator seeded with `seed` that can be handed to
+        DataLoaders, so loader RNG does not contend on global state.
+        None if with_torch is false.
     """
+    base_generator = None
     random.seed(seed)
     np.random.seed(seed)
     if with_torch:
         torch.manual_seed(seed)
-    if with_cuda:
+        base_generator = torch.Generator().manual_seed(seed)
+    if with_cuda and torch.cuda.is_available():
         torch.cuda.manual_seed(seed)
         torch.cuda.manual_seed_all(seed)
-        torch.backends.cudnn.deterministic = True
+        if not torch.backends.cudnn.deterministic:
+            torch.backends.cudnn.deterministic = True
+    return base_generator
 
 
 def compute_and_store_final_results(
@@ -163,28 +348,33 @@ def compute_and_store_final_results(
     if row_names is not None:
         assert len(row_names) == len(results), "#Rownames != #Result-rows."
 
-    mean_metrics = {}
-    for i, result_key in enumerate(column_names):
-        mean_metrics[result_key] = np.mean([x[i] for x in results])
+    results_arr = np.asarray(
+        [result[-len(column_names):] for result in results], dtype=np.float64
+    )
+    mean_metrics = dict(zip(column_names, results_arr.mean(axis=0)))
+    for result_key in column_names:
         LOGGER.info("{0}: {1:3.3f}".format(result_key, mean_metrics[result_key]))
 
     savename = os.path.join(results_path, "results.csv")
-    with open(savename, "w") as csv_file:
-        csv_writer = csv.writer(csv_file, delimiter=",")
-        header = column_names
-        if row_names is not None:
-            header = ["Row Names"] + header
-
-        csv_writer.writerow(header)
-        for i, result_list in enumerate(results):
-            csv_row = result_list
-            if row_names is not None:
-                csv_row = [row_names[i]] + result_list
-            csv_writer.writerow(csv_row)
-        mean_scores = list(mean_metrics.values())
+    header = list(column_names)
+    if row_names is not None:
+        header = ["Row Names"] + header
+
+    all_rows = [header]
+    for i, result_list in enumerate(results):
+        csv_row = list(result_list)
         if row_names is not None:
-            mean_scores = ["Mean"] + mean_scores
-        csv_writer.writerow(mean_scores)
+            csv_row = [row_names[i]] + csv_row
+        all_rows.append(csv_row)
+    mean_scores = list(mean_metrics.values())
+    if row_names is not None:
+        mean_scores = ["Mean"] + mean_scores
+    all_rows.append(mean_scores)
+
+    with open(savename, "w") as csv_file:
+        csv_file.write(
+            "\n".join(",".join(map(str, row)) for row in all_rows) + "\n"
+        )
 
     mean_metrics = {"mean_{0}".format(key): item for key, item in mean_metrics.items()}
     return mean_metrics
@@ -198,9 +388,26 @@ def dataset(
         resize = 224,
         image_size = 224,
         num_workers = 2,
-        augment = True
+        prefetch_factor = 4,
+        persistent_workers = True,
+        augment = True,
+        gpu_transforms = False,
+        seed = 0
 ):
     def get_dataloaders():
+        pin_memory = torch.cuda.is_available()
+        pin_memory_device = 'cuda' if pin_memory else ''
+        # Dedicated generator + per-worker seeding keeps loader RNG off the
+        # global torch state and reproducible under persistent_workers.
+        generator = torch.Generator().manual_seed(seed)
+        worker_init_fn = (
+            (lambda worker_id: torch.manual_seed(seed + worker_id))
+            if num_workers > 0 else None
+        )
+        # prefetch_factor is only accepted with worker processes.
+        prefetch_kwargs = (
+            {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
+        )
         dataloaders = []
         for subdataset in subdatasets:
             train_dataset = MVTecDataset(
@@ -209,7 +416,8 @@ def dataset(
                 split = DatasetSplit.TRAIN,
                 resize = resize,
                 augment = augment,
-                train_val_split = train_val_split
+                train_val_split = train_val_split,
+                gpu_transforms = gpu_transforms
             )
 
             test_dataset = MVTecDataset(
@@ -218,7 +426,8 @@ def dataset(
                 split = DatasetSplit.TEST,
                 resize = resize,
                 imagesize=image_size,
-                train_val_split = train_val_split
+                train_val_split = train_val_split,
+                gpu_transforms = gpu_transforms
             )
             
             train_loader = torch.utils.data.DataLoader(
@@ -226,16 +435,23 @@ def dataset(
                 batch_size = batch_size,
                 shuffle = True,
                 num_workers = num_workers,
-                prefetch_factor = 2,
-                pin_memory = True,)
-            
+                persistent_workers = persistent_workers and num_workers > 0,
+                pin_memory = pin_memory,
+                pin_memory_device = pin_memory_device,
+                generator = generator,
+                worker_init_fn = worker_init_fn,
+                **prefetch_kwargs,)
+
             test_loader = torch.utils.data.DataLoader(
                 test_dataset,
                 batch_size = batch_size,
                 shuffle = False,
                 num_workers = num_workers,
-                prefetch_factor = 2,
-                pin_memory = True,)
+                persistent_workers = persistent_workers and num_workers > 0,
+                pin_memory = pin_memory,
+                pin_memory_device = pin_memory_device,
+                worker_init_fn = worker_init_fn,
+                **prefetch_kwargs,)
             
             train_loader.name = name
             train_loader.name += '_' + subdataset
@@ -249,28 +465,116 @@ def dataset(
     return ("get_dataloaders", get_dataloaders)
 
 
+def gpu_transform(resize = 224, imagesize = 224, device = 'cuda'):
+    """Resize/crop/normalize a uint8 image batch on the GPU.
+
+    Mirrors the CPU-side MVTec transforms for loaders built with
+    dataset(..., gpu_transforms=True), which yield raw uint8 images.
+    Pass the same resize/image_size values that were given to dataset();
+    the defaults match dataset()'s (224/224, no crop). Apply the returned
+    function to sample['image'] in the training step, and
+    gpu_mask_transform's to sample['mask'].
+    """
+    mean = torch.tensor(IMAGENET_MEAN, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=device).view(1, 3, 1, 1)
+
+    def transform(images):
+        images = images.to(device, non_blocking=True).float().div_(255)
+        images = torch.nn.functional.interpolate(
+            images, size=(resize, resize), mode='bilinear', align_corners=False
+        )
+        top = (resize - imagesize) // 2
+        images = images[:, :, top:top + imagesize, top:top + imagesize]
+        return images.sub_(mean).div_(std)
+
+    return transform
+
+
+def gpu_mask_transform(resize = 224, imagesize = 224, device = 'cuda'):
+    """Counterpart of gpu_transform for sample['mask'] batches.
+
+    Brings the raw uint8 0/255 masks of a gpu_transforms=True loader to
+    the same float 0-1, imagesize-sized form the CPU-side transform_mask
+    produces, using nearest-neighbor resizing to keep them binary.
+    """
+    def transform(masks):
+        masks = masks.to(device, non_blocking=True).float().div_(255)
+        masks = torch.nn.functional.interpolate(
+            masks, size=(resize, resize), mode='nearest'
+        )
+        top = (resize - imagesize) // 2
+        return masks[:, :, top:top + imagesize, top:top + imagesize]
+
+    return transform
+
+
 def save_segmentation_images(data, segementations, scores):
     if isinstance(data, torch.utils.data.DataLoader):
-        image_paths = [
-            x[2] for x in data.dataset.data_to_iterate
-        ]
-        mask_paths = [
-            x[3] for x in data.dataset.data_to_iterate
-        ]
-        def image_transform(image):
-            in_std = np.array(
-                data.dataset.transform_std
-            ).reshape(-1, 1, 1)
-            in_mean = np.array(
-                data.dataset.transform_mean
-            ).reshape(-1, 1, 1)
-            image = data.dataset.transform_img(image)
-            img =  np.clip(
-                (image.numpy() * in_std + in_mean) * 255, 0, 255
-            ).astype(np.uint8)
-            return img
-        def mask_transform(mask):
-            return data.dataset.transform_mask(mask).numpy()
+        image_paths = data.dataset.image_paths
+        mask_paths = data.dataset.mask_paths
+        if getattr(data.dataset, 'gpu_transforms', False):
+            # gpu-mode samples were never normalized on the CPU, so the
+            # decoded uint8 tensors are display-ready once brought to the
+            # dataset's output size so they tile with the segmentations.
+            imagesize = data.dataset.imagesize[-1]
+            resize_img = transforms.Compose([
+                transforms.Resize(imagesize),
+                transforms.CenterCrop(imagesize),
+            ])
+            resize_mask = transforms.Compose([
+                transforms.Resize(
+                    imagesize,
+                    interpolation=transforms.InterpolationMode.NEAREST,
+                ),
+                transforms.CenterCrop(imagesize),
+            ])
+            def image_transform(image):
+                return resize_img(image).numpy()
+            def mask_transform(mask):
+                return resize_mask(mask).numpy()
+        else:
+            def _tensor_transforms(composed):
+                # The dataset pipelines start from PIL images; swap ToTensor
+                # for a dtype conversion so they run on decoded uint8 tensors.
+                if not isinstance(composed, transforms.Compose):
+                    return composed
+                return transforms.Compose([
+                    transforms.ConvertImageDtype(torch.float32)
+                    if isinstance(t, transforms.ToTensor) else t
+                    for t in composed.transforms
+                ])
+
+            transform_img = _tensor_transforms(data.dataset.transform_img)
+            transform_mask = _tensor_transforms(data.dataset.transform_mask)
+            in_std = np.asarray(
+                data.dataset.transform_std, dtype=np.float32
+            ).reshape(-1, 1, 1) * 255
+            in_mean = np.asarray(
+                data.dataset.transform_mean, dtype=np.float32
+            ).reshape(-1, 1, 1) * 255
+            # One scratch buffer per render thread (plot_segmentation_images
+            # is threaded).
+            scratch = threading.local()
+            def image_transform(image):
+                image_np = transform_img(image).numpy()
+                if numba is not None:
+                    out = np.empty(image_np.shape, dtype=np.uint8)
+                    _denorm_u8(image_np, in_std.ravel(), in_mean.ravel(), out)
+                    return out
+                buffers = getattr(scratch, 'buffers', None)
+                if buffers is None:
+                    buffers = scratch.buffers = {}
+                buf = buffers.get(image_np.shape)
+                if buf is None:
+                    buf = buffers[image_np.shape] = np.empty(
+                        image_np.shape, dtype=np.float32
+                    )
+                np.multiply(image_np, in_std, out=buf)
+                buf += in_mean
+                np.clip(buf, 0, 255, out=buf)
+                return buf.astype(np.uint8, copy=False)
+            def mask_transform(mask):
+                return transform_mask(mask).numpy()
         plot_segmentation_images(
             'outputs',
             image_paths,